@@ -0,0 +1,69 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+class MicroBatcher:
+    """
+    Coalesce calls arriving within a short window into a single batch, handled on a
+    background thread. `handler(items)` must return one result per item, in order.
+    """
+    def __init__(self, handler, max_batch=8, max_wait_ms=50):
+        self.handler = handler
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """Queue an item and return a Future resolving to its result."""
+        future = Future()
+        if self._stop.is_set():
+            future.set_exception(RuntimeError("Batcher is closed"))
+        else:
+            self._queue.put((item, future))
+        return future
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=1)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                batch = [self._queue.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+
+            # Keep collecting until the window closes or the batch is full
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                results = self.handler([item for item, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                logger.error(f"Batch handler failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+
+        # Fail anything still queued so callers don't block forever
+        while True:
+            try:
+                _, future = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            future.set_exception(RuntimeError("Batcher is closed"))
@@ -1,107 +1,371 @@
+import hashlib
 import logging
-import requests
-import json
+import math
+import orjson
 import os
+import re
+import threading
+import time
+from app.ai.batch import MicroBatcher
+from app.cache import TTLCache
+from app.clients.session import create_session
 
 logger = logging.getLogger(__name__)
 
+CONTEXT_JSON_OPTS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+JSON_ARRAY_RE = re.compile(r'\[.*\]', re.DOTALL)
+
+CHAT_CACHE_TTL = 300  # seconds
+ANALYZE_CACHE_TTL = 60
+MAX_EMBEDDINGS = 256
+PROBE_INTERVAL = 30  # seconds between Ollama availability checks
+KEEP_ALIVE = "10m"  # keep the model resident between polls
+
+SYSTEM_PREAMBLE = (
+    "You are a Network Operations center AI assistant. "
+    "You are monitoring a home/lab network.\n"
+    "Answering guidelines:\n"
+    "- Be concise and professional.\n"
+    "- If the user asks about devices, look at the 'devices' list.\n"
+    "- If the user asks about alerts, look at 'alerts'.\n"
+    "- Highlight any security risks or anomalies.\n\n"
+    "Here is the current network state in JSON format:\n"
+)
+
+# Compact schema used for analyze snapshots; described to the model in the prompts below
+SNAPSHOT_SCHEMA = (
+    "Snapshots use short keys: 'devices' is a list of {h: hostname, i: IP, m: MAC, t: type}, "
+    "'opn_alerts' is a list of {s: severity, m: message}. "
+)
+
+ANALYZE_PROMPT = (
+    "Analyze the network device list and OPNsense alerts given by the user for anomalies. "
+    + SNAPSHOT_SCHEMA +
+    "Look for: Security risks, unknown devices, high load, or unusual services. "
+    "Return ONLY a JSON array of objects with keys: 'severity' (info/warning/error), 'message' (string). "
+    "Do not include markdown formatting or explanation text outside the JSON."
+)
+
+ANALYZE_BATCH_PROMPT = (
+    "The user gives a JSON array of independent network snapshots, each with a device list and OPNsense alerts. "
+    "Analyze each snapshot for anomalies. "
+    + SNAPSHOT_SCHEMA +
+    "Look for: Security risks, unknown devices, high load, or unusual services. "
+    "Return ONLY a JSON array with one entry per snapshot, in the same order; each entry is a JSON array "
+    "of objects with keys: 'severity' (info/warning/error), 'message' (string). "
+    "Do not include markdown formatting or explanation text outside the JSON."
+)
+
+# Rough token estimate (~4 chars/token) of the static chat prefix Ollama should keep on context shift.
+# Analyze requests keep their whole (static) system prompt instead.
+PREFIX_TOKENS = len(SYSTEM_PREAMBLE) // 4
+
+class AIProviderError(Exception):
+    """Ollama answered with a non-200 status."""
+
+
 class LocalAI:
     def __init__(self, base_url="http://localhost:11434", model="llama3"):
         self.base_url = os.getenv("OLLAMA_URL", base_url)
         self.model = os.getenv("OLLAMA_MODEL", model)
         self.enabled = False
-        self._check_connection()
+        self.session = create_session()
+        # Health probe is a single attempt: no retry warnings while Ollama is down
+        self._probe_session = create_session(pool_connections=1, pool_maxsize=1, retries=0)
+
+        # Response cache: exact match on the full prompt, plus an optional
+        # semantic tier matching similar user prompts against the same context.
+        # LOCALAI_CACHE_TTL=0 disables both.
+        self.cache_ttl = float(os.getenv("LOCALAI_CACHE_TTL", CHAT_CACHE_TTL))
+        self.semantic_cache = os.getenv("LOCALAI_SEMANTIC_CACHE", "false").lower() in ("1", "true", "yes")
+        self.semantic_threshold = float(os.getenv("LOCALAI_SEMANTIC_THRESHOLD", "0.95"))
+        self.embed_model = os.getenv("LOCALAI_EMBED_MODEL", self.model)
+        self._cache = TTLCache(ttl=self.cache_ttl, maxsize=512)
+        self._embeddings = []  # (context_key, unit vector, cache key)
+        self._embeddings_lock = threading.Lock()
+
+        # Coalesces concurrent analyze() calls into one Ollama request
+        self._analyze_batcher = MicroBatcher(self._analyze_batch, max_batch=8, max_wait_ms=50)
+
+        # Probe Ollama in the background so startup never blocks on it, and keep
+        # re-probing so `enabled` follows Ollama restarts.
+        self._last_probe = 0.0
+        self._stop = threading.Event()
+        threading.Thread(target=self._probe_loop, daemon=True).start()
+
+    def close(self):
+        self._stop.set()
+        self._analyze_batcher.close()
+        self.session.close()
+        self._probe_session.close()
+
+    def _probe_loop(self):
+        while not self._stop.is_set():
+            self._check_connection()
+            self._stop.wait(PROBE_INTERVAL)
 
     def _check_connection(self):
+        # Only log on state changes (and the first probe) to keep the periodic probe quiet
+        first_probe = not self._last_probe
+        was_enabled = self.enabled
         try:
             # Quick check to see if Ollama is running
-            res = requests.get(f"{self.base_url}/api/tags", timeout=2)
+            res = self._probe_session.get(f"{self.base_url}/api/tags", timeout=2)
             if res.status_code == 200:
                 self.enabled = True
-                logger.info(f"Connected to Local AI at {self.base_url} using model {self.model}")
+                if not was_enabled:
+                    logger.info(f"Connected to Local AI at {self.base_url} using model {self.model}")
             else:
-                logger.warning(f"Local AI at {self.base_url} returned {res.status_code}")
+                self.enabled = False
+                if was_enabled or first_probe:
+                    logger.warning(f"Local AI at {self.base_url} returned {res.status_code}")
         except Exception:
-            logger.warning(f"Could not connect to Local AI at {self.base_url}. AI features will be limited.")
+            self.enabled = False
+            if was_enabled or first_probe:
+                logger.warning(f"Could not connect to Local AI at {self.base_url}. AI features will be limited.")
+        self._last_probe = time.monotonic()
 
-    def chat(self, user_prompt: str, context_data: dict):
+    def _embed(self, text):
+        """Return a unit-length embedding for text, or None if unavailable."""
+        try:
+            res = self.session.post(f"{self.base_url}/api/embeddings",
+                                    json={"model": self.embed_model, "prompt": text}, timeout=5)
+            if res.status_code != 200:
+                return None
+            vec = res.json().get("embedding") or []
+            norm = math.sqrt(sum(x * x for x in vec))
+            return [x / norm for x in vec] if norm else None
+        except Exception as e:
+            logger.debug(f"Embedding request failed: {e}")
+            return None
+
+    def _semantic_lookup(self, context_key, vec):
+        """Find the cache key of the most similar past prompt asked against the same context."""
+        best_key, best_sim = None, self.semantic_threshold
+        with self._embeddings_lock:
+            for ctx, other, key in self._embeddings:
+                if ctx != context_key or len(other) != len(vec):
+                    continue
+                sim = sum(a * b for a, b in zip(vec, other))
+                if sim >= best_sim:
+                    best_key, best_sim = key, sim
+        return best_key
+
+    def _remember_embedding(self, context_key, vec, key):
+        with self._embeddings_lock:
+            self._embeddings.append((context_key, vec, key))
+            if len(self._embeddings) > MAX_EMBEDDINGS:
+                del self._embeddings[0]
+
+    def chat(self, user_prompt: str, context_data: dict, ttl=None, semantic=True):
         """
         Send a chat prompt to the local AI with network context.
+        Responses are cached for `ttl` seconds (defaults to LOCALAI_CACHE_TTL).
         """
         if not self.enabled:
             return "Local AI is not connected. Please ensure Ollama is running."
 
-        # Construct a system prompt with the current state
-        system_prompt = (
-            "You are a Network Operations center AI assistant. "
-            "You are monitoring a home/lab network. "
-            "Here is the current network state in JSON format:\n"
-            f"{json.dumps(context_data, indent=2)}\n\n"
-            "Answering guidelines:\n"
-            "- Be concise and professional.\n"
-            "- If the user asks about devices, look at the 'devices' list.\n"
-            "- If the user asks about alerts, look at 'alerts'.\n"
-            "- Highlight any security risks or anomalies.\n"
-        )
-
-        full_prompt = f"System Context: {system_prompt}\n\nUser: {user_prompt}\nAssistant:"
+        # Static framing first, then the network state, so Ollama can reuse the
+        # KV cache for the shared prefix. The user prompt goes in its own message.
+        system_prompt = SYSTEM_PREAMBLE + self._dump_context(context_data)
+        return self._complete(system_prompt, user_prompt, ttl=ttl, semantic=semantic,
+                              num_keep=PREFIX_TOKENS)
+
+    def _dump_context(self, context_data):
+        if logger.isEnabledFor(logging.DEBUG):
+            # Readable copy for the log only; the wire format stays compact
+            logger.debug("AI context:\n%s", orjson.dumps(context_data, default=str,
+                         option=CONTEXT_JSON_OPTS | orjson.OPT_INDENT_2).decode())
+        # Sorted keys keep the prefix stable across calls and orjson output is already compact;
+        # default=str keeps odd values (datetimes etc.) from failing the whole prompt
+        return orjson.dumps(context_data, default=str, option=CONTEXT_JSON_OPTS).decode()
+
+    def _cache_key(self, system_prompt, user_prompt):
+        return hashlib.sha256((self.model + system_prompt + user_prompt).encode()).hexdigest()
+
+    def _complete(self, system_prompt, user_prompt, ttl=None, semantic=True, num_keep=None):
+        """
+        Run a system + user exchange against Ollama's chat API, going through the response cache.
+        """
+        ttl = self.cache_ttl if ttl is None else min(ttl, self.cache_ttl)
+        use_semantic = semantic and self.semantic_cache and ttl > 0
+        key = context_key = vec = None
+        if ttl > 0:
+            key = self._cache_key(system_prompt, user_prompt)
+            cached = self._cache.get(key)
+            if cached is not None:
+                return cached
+            if use_semantic:
+                context_key = hashlib.sha256((self.model + system_prompt).encode()).hexdigest()
+                vec = self._embed(user_prompt)
+                if vec:
+                    similar = self._semantic_lookup(context_key, vec)
+                    cached = self._cache.get(similar) if similar else None
+                    if cached is not None:
+                        return cached
 
         try:
-            # Using Ollama's generate API (simple stream=False for now)
-            payload = {
-                "model": self.model,
-                "prompt": full_prompt,
-                "stream": False
-            }
-            response = requests.post(f"{self.base_url}/api/generate", json=payload, timeout=30)
-            if response.status_code == 200:
-                return response.json().get("response", "No response from AI.")
-            else:
-                return f"Error from AI Provider: {response.text}"
+            answer = "".join(self._stream(system_prompt, user_prompt, num_keep)) or "No response from AI."
+        except AIProviderError as e:
+            return str(e)
         except Exception as e:
             logger.error(f"AI Chat Error: {e}")
             return "Failed to communicate with Local AI."
 
+        if key:
+            self._cache.set(key, answer, ttl=ttl)
+            if vec:
+                self._remember_embedding(context_key, vec, key)
+        return answer
+
+    def _stream(self, system_prompt, user_prompt, num_keep=None):
+        """
+        Yield response text chunks from Ollama's streaming chat API as they are generated.
+        `num_keep` is the token count of the static system prefix; defaults to the whole system prompt.
+        """
+        if num_keep is None:
+            num_keep = len(system_prompt) // 4
+        payload = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "stream": True,
+            "keep_alive": KEEP_ALIVE,
+            "options": {"num_keep": num_keep}
+        }
+        with self.session.post(f"{self.base_url}/api/chat", json=payload,
+                               stream=True, timeout=(5, 120)) as response:
+            if response.status_code != 200:
+                raise AIProviderError(f"Error from AI Provider: {response.text}")
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = orjson.loads(line)
+                piece = chunk.get("message", {}).get("content", "")
+                if piece:
+                    yield piece
+                if chunk.get("done"):
+                    break
+
+    def chat_stream(self, user_prompt: str, context_data: dict):
+        """
+        Like chat(), but yields the answer incrementally as Ollama generates it.
+        A cached answer is yielded in one piece; a completed stream is stored in the cache.
+        """
+        if not self.enabled:
+            yield "Local AI is not connected. Please ensure Ollama is running."
+            return
+
+        system_prompt = SYSTEM_PREAMBLE + self._dump_context(context_data)
+        key = self._cache_key(system_prompt, user_prompt) if self.cache_ttl > 0 else None
+        cached = self._cache.get(key) if key else None
+        if cached is not None:
+            yield cached
+            return
+
+        parts = []
+        try:
+            for piece in self._stream(system_prompt, user_prompt, PREFIX_TOKENS):
+                parts.append(piece)
+                yield piece
+        except AIProviderError as e:
+            yield str(e)
+            return
+        except Exception as e:
+            logger.error(f"AI Chat Stream Error: {e}")
+            yield "Failed to communicate with Local AI."
+            return
+
+        if key and parts:
+            self._cache.set(key, "".join(parts))
+
     def analyze(self, devices, opn_alerts):
         """
         Analyze network state for anomalies using the LLM.
         Returns a list of analytical alerts.
+        Concurrent callers are coalesced by the micro-batcher into a single Ollama request.
+        """
+        return self.analyze_with_source(devices, opn_alerts)[0]
+
+    def analyze_with_source(self, devices, opn_alerts):
+        """
+        Like analyze(), but returns (alerts, from_model). from_model is False when the
+        heuristic fallback answered (AI down, request failed or unparseable output).
         """
         if not self.enabled:
             # Fallback to the old heuristic if AI is down
-            return self._fallback_analyze(devices, opn_alerts)
-
-        prompt = (
-            "Analyze this network device list and OPNsense alerts for anomalies. "
-            "Look for: Security risks, unknown devices, high load, or unusual services. "
-            "Return ONLY a JSON array of objects with keys: 'severity' (info/warning/error), 'message' (string)."
-            "Do not include markdown formatting or explanation text outside the JSON."
-        )
-        
+            return self._fallback_analyze(devices, opn_alerts), False
+
+        return self._analyze_batcher.submit((devices, opn_alerts)).result()
+
+    def _analyze_context(self, devices, opn_alerts):
+        # Only the fields the model needs, under single-letter keys (see SNAPSHOT_SCHEMA).
+        # Graph nodes carry the display name as 'label' rather than 'hostname'.
         context = {
-            "devices": devices[:50], # Limit context size
-            "opn_alerts": opn_alerts
+            "devices": [{
+                "h": (d.get("hostname") or d.get("label") or "")[:32],
+                "i": d.get("ip", ""),
+                "m": d.get("mac", ""),
+                "t": d.get("type", "")
+            } for d in devices[:50]], # Limit context size
+            "opn_alerts": [{"s": a.get("severity", ""), "m": a.get("message", "")} for a in opn_alerts or []]
         }
-        
+        return self._dump_context(context)
+
+    def _analyze_batch(self, items):
+        """
+        Batcher handler: analyze several (devices, opn_alerts) snapshots with one request.
+        Returns one (alerts, from_model) pair per item.
+        """
+        contexts = [self._analyze_context(devices, opn_alerts) for devices, opn_alerts in items]
+        unique = list(dict.fromkeys(contexts))
+        if len(unique) == 1:
+            # Nothing to combine (single caller or identical snapshots)
+            result, from_model = self._analyze_one(items[0], unique[0])
+            return [([dict(a) for a in result], from_model) for _ in items]
+
+        user_prompt = "[" + ",".join(unique) + "]"
         try:
-            response = self.chat(prompt, context)
-            # clean up response to ensure valid json
-            response = response.strip()
-            if response.startswith("```json"):
-                response = response.split("```json")[1].split("```")[0]
-            elif response.startswith("```"):
-                 response = response.split("```")[1].split("```")[0]
-            
-            anomalies = json.loads(response)
+            response = self._complete(ANALYZE_BATCH_PROMPT, user_prompt,
+                                      ttl=ANALYZE_CACHE_TTL, semantic=False)
+            results = orjson.loads(self._extract_json(response))
+            if not isinstance(results, list) or len(results) != len(unique) \
+                    or not all(isinstance(r, list) for r in results):
+                raise ValueError(f"expected {len(unique)} result arrays")
+        except Exception as e:
+            logger.error(f"AI batch analyze failed, analyzing individually: {e}")
+            return [self._analyze_one(item, context) for item, context in zip(items, contexts)]
+
+        by_context = dict(zip(unique, results))
+        return [(self._stamp(by_context[context]), True) for context in contexts]
+
+    def _analyze_one(self, item, context):
+        devices, opn_alerts = item
+        try:
+            # The instruction is static (system), only the snapshot varies (user)
+            response = self._complete(ANALYZE_PROMPT, context, ttl=ANALYZE_CACHE_TTL, semantic=False)
+            anomalies = orjson.loads(self._extract_json(response))
             if isinstance(anomalies, list):
-                # Add timestamps
-                for a in anomalies:
-                    a['timestamp'] = "Just now"
-                return anomalies
+                return self._stamp(anomalies), True
         except Exception as e:
             logger.error(f"AI Analyze failed to parse: {e}")
             
-        return self._fallback_analyze(devices, opn_alerts)
+        return self._fallback_analyze(devices, opn_alerts), False
+
+    def _extract_json(self, response):
+        # Outermost JSON array, ignoring code fences and any text around it
+        m = JSON_ARRAY_RE.search(response)
+        return m.group(0) if m else response
+
+    def _stamp(self, anomalies):
+        # Model output is untrusted: keep only well-formed severity/message pairs, and add timestamps
+        return [
+            {"severity": a["severity"], "message": a["message"], "timestamp": "Just now"}
+            for a in anomalies
+            if isinstance(a, dict) and isinstance(a.get("severity"), str) and isinstance(a.get("message"), str)
+        ]
 
     def _fallback_analyze(self, devices, opn_alerts):
         """Original heuristic logic as fallback"""
@@ -114,7 +378,7 @@ class LocalAI:
                 "timestamp": "Now"
             })
         for alert in opn_alerts:
-            if "CPU" in alert.get('message', ''):
+            if "CPU" in (alert.get('message') or ''):
                  anomalies.append({
                     "severity": "warning",
                     "message": "Basic Insight: High Firewall Load detected.",
@@ -0,0 +1,74 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+# Upstream API responses (OPNsense, Proxmox): back-to-back scans and /api/alerts polls
+# within this window reuse the last response
+API_CACHE_TTL = 15
+
+
+class TTLCache:
+    """
+    Small thread-safe LRU cache whose entries expire after a TTL (seconds).
+    """
+    def __init__(self, ttl=60, maxsize=512):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def ttl_cached(ttl, maxsize=32):
+    """
+    Cache a method's result per instance and positional arguments for `ttl` seconds.
+    None results are not cached. The cache is exposed as `method.cache`.
+    """
+    def decorator(func):
+        cache = TTLCache(ttl=ttl, maxsize=maxsize)
+
+        @functools.wraps(func)
+        def wrapper(self, *args):
+            key = (self, args)
+            result = cache.get(key)
+            if result is None:
+                result = func(self, *args)
+                if result is not None:
+                    cache.set(key, result)
+            return result
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
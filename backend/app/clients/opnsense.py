@@ -1,9 +1,21 @@
-import requests
+import logging
 import urllib3
 import os
+from concurrent.futures import ThreadPoolExecutor
+from app.cache import API_CACHE_TTL, ttl_cached
+from app.clients.session import create_session
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+logger = logging.getLogger(__name__)
+
+def lower_macs(rows):
+    """Lowercase the 'mac' of each row in place so callers can use it as a lookup key."""
+    for row in rows:
+        if isinstance(row, dict) and row.get('mac'):
+            row['mac'] = row['mac'].lower()
+    return rows
+
 class OpnSenseClient:
     def __init__(self, host=None, api_key=None, api_secret=None, verify_ssl=False):
         self.host = host or os.getenv("OPNSENSE_HOST")
@@ -12,28 +24,32 @@ class OpnSenseClient:
         self.verify_ssl = verify_ssl
         self.base_url = f"https://{self.host}/api" if self.host else None
 
+        # Pooled keep-alive session, credentials applied once
+        self.session = create_session()
+        self.session.auth = (self.key, self.secret)
+        self.session.verify = self.verify_ssl
+
+    def close(self):
+        self.session.close()
+
     def _get(self, endpoint):
         if not self.base_url or not self.key or not self.secret:
              return None
         try:
-            response = requests.get(
-                f"{self.base_url}/{endpoint}",
-                auth=(self.key, self.secret),
-                verify=self.verify_ssl,
-                timeout=5
-            )
+            response = self.session.get(f"{self.base_url}/{endpoint}", timeout=5)
             response.raise_for_status()
             return response.json()
         except Exception as e:
-            # print(f"Error fetching {endpoint}: {e}")
+            logger.debug("Error fetching %s: %s", endpoint, e)
             return None
 
+    @ttl_cached(API_CACHE_TTL)
     def get_dhcp_leases(self):
         data = self._get("dhcpv4/leases/searchLease")
         if data:
-            # print(f"DEBUG_DHCP: {data}")
             rows = data.get('rows', [])
-            # Normalize description
+            # Normalize description and MAC case
+            lower_macs(rows)
             for row in rows:
                 if 'descr' in row and row['descr']:
                     row['description'] = row['descr']
@@ -42,27 +58,29 @@ class OpnSenseClient:
             return rows
         return []
 
+    @ttl_cached(API_CACHE_TTL)
     def get_arp_table(self):
         # Trying multiple potential endpoints for ARP
         # 1. Diagnostics (most common for simple ARP dump)
         data = self._get("diagnostics/interface/getArp")
         if data:
-            print(f"DEBUG_ARP_DIAG: found {len(data)} entries")
-            return data
+            logger.debug("ARP_DIAG: found %d entries", len(data))
+            return lower_macs(data)
             
         # 2. Interface (sometimes here)
         data = self._get("interfaces/diagnostics/arp")
         if data:
-             print(f"DEBUG_ARP_INT: found {len(data)} entries")
-             return data
+             logger.debug("ARP_INT: found %d entries", len(data))
+             return lower_macs(data)
              
-        print("DEBUG_ARP: No ARP data found")
+        logger.debug("ARP: No ARP data found")
         return []
 
     def get_status(self):
         # Check system status
         return {"status": "online" if self.base_url else "mock-online"}
 
+    @ttl_cached(API_CACHE_TTL)
     def get_alerts(self):
         # Fetch system status and convert to alerts
         if not self.base_url:
@@ -71,7 +89,7 @@ class OpnSenseClient:
         alerts = []
         try:
             status_data = self._get("core/system/status")
-            print(f"DEBUG_STATUS: {status_data}") # DEBUG
+            logger.debug("STATUS: %s", status_data)
             
             # Example response: {"system": {"status": 0, "message": "OK"}}
             # Status: 0=OK, 1=Warning, 2=Error (approx)
@@ -96,8 +114,7 @@ class OpnSenseClient:
                     })
 
         except Exception as e:
-            print(f"Error fetching OPNsense alerts: {e}")
-            pass
+            logger.error("Error fetching OPNsense alerts: %s", e)
             
         return alerts
 
@@ -109,3 +126,19 @@ class OpnSenseClient:
             return status
         return {}
 
+    def snapshot(self, *parts):
+        """
+        Fetch independent endpoints concurrently over the pooled session.
+        parts: any of "dhcp", "arp", "alerts", "gateway" (default: all).
+        Returns a dict keyed by part.
+        """
+        getters = {
+            "dhcp": self.get_dhcp_leases,
+            "arp": self.get_arp_table,
+            "alerts": self.get_alerts,
+            "gateway": self.get_gateway_status,
+        }
+        parts = parts or tuple(getters)
+        with ThreadPoolExecutor(max_workers=len(parts)) as ex:
+            futures = {part: ex.submit(getters[part]) for part in parts}
+            return {part: f.result() for part, f in futures.items()}
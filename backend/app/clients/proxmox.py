@@ -1,5 +1,24 @@
 from proxmoxer import ProxmoxAPI
+from concurrent.futures import ThreadPoolExecutor
+from app.cache import API_CACHE_TTL, TTLCache, ttl_cached
 import os
+import re
+
+# Concurrent config lookups per scan. proxmoxer's https backend shares one requests
+# session, so threads reuse its keep-alive connections; sized to its default pool of 10.
+MAX_WORKERS = 10
+
+# Guest configs (we only read net0) and cluster membership rarely change
+CONFIG_CACHE_TTL = 300
+NODES_CACHE_TTL = 3600
+
+# First value in a net0 string that is exactly a MAC (so gw6= and ip6= addresses never match); covers QEMU ("virtio=AA:BB:..,bridge=vmbr0")
+# and LXC ("name=eth0,bridge=vmbr0,hwaddr=AA:BB:..") formats alike
+MAC_RE = re.compile(r'(?<==)[0-9A-Fa-f]{2}(?::[0-9A-Fa-f]{2}){5}(?![0-9A-Fa-f:])')
+
+def parse_mac(net0):
+    m = MAC_RE.search(net0 or '')
+    return m.group(0).lower() if m else ""
 
 class ProxmoxClient:
     def __init__(self, host=None, user=None, password=None, verify_ssl=False):
@@ -8,6 +27,8 @@ class ProxmoxClient:
         self.password = password or os.getenv("PROXMOX_PASSWORD")
         self.verify_ssl = verify_ssl
         self.proxmox = None
+        self._config_cache = TTLCache(ttl=CONFIG_CACHE_TTL, maxsize=512)
+        self._nodes_cache = TTLCache(ttl=NODES_CACHE_TTL, maxsize=1)
         
         if self.host and self.user and self.password:
             # Handle host:port format if present
@@ -18,11 +39,13 @@ class ProxmoxClient:
 
             try:
                 self.proxmox = ProxmoxAPI(
-                    self.host, user=self.user, password=self.password, verify_ssl=self.verify_ssl, port=port
+                    self.host, user=self.user, password=self.password, verify_ssl=self.verify_ssl, port=port,
+                    backend='https'
                 )
             except Exception as e:
                 print(f"Failed to connect to Proxmox: {e}")
 
+    @ttl_cached(API_CACHE_TTL)
     def get_nodes(self):
         if not self.proxmox:
             return [{"node": "pve-mock"}]
@@ -48,75 +71,77 @@ class ProxmoxClient:
             return []
 
     def get_vm_config(self, node, vmid):
-        try:
-            return self.proxmox.nodes(node).qemu(vmid).config.get()
-        except:
-            return {}
+        config = self._config_cache.get(("qemu", node, vmid))
+        if config is None:
+            try:
+                config = self.proxmox.nodes(node).qemu(vmid).config.get()
+            except:
+                return {}
+            self._config_cache.set(("qemu", node, vmid), config)
+        return config
 
     def get_lxc_config(self, node, vmid):
-        try:
-            return self.proxmox.nodes(node).lxc(vmid).config.get()
-        except:
-            return {}
+        config = self._config_cache.get(("lxc", node, vmid))
+        if config is None:
+            try:
+                config = self.proxmox.nodes(node).lxc(vmid).config.get()
+            except:
+                return {}
+            self._config_cache.set(("lxc", node, vmid), config)
+        return config
+
+    def _get_cluster_nodes(self):
+        # Long-lived node list for resource discovery; get_nodes() only caches for
+        # API_CACHE_TTL because it doubles as the connectivity check for alerts.
+        nodes = self._nodes_cache.get("nodes")
+        if nodes is None:
+            nodes = self.get_nodes()
+            if nodes and self.proxmox:
+                self._nodes_cache.set("nodes", nodes)
+        return nodes
     
+    @ttl_cached(API_CACHE_TTL)
     def get_all_resources(self):
         resources = []
-        nodes = self.get_nodes()
-        for node in nodes:
-            node_name = node['node']
-            # Add the node itself
-            resources.append({"type": "node", "name": node_name, "id": node_name, "status": "online"})
-            
-            # VMs
-            vms = self.get_vms(node_name)
-            for vm in vms:
-                vmid = vm.get('vmid')
-                config = self.get_vm_config(node_name, vmid)
-                # Parse MAC from net0 (e.g., "virtio=AA:BB:CC:...,bridge=vmbr0")
-                mac = ""
-                net0 = config.get('net0', '')
-                # Parse MAC from net0. Format varies: "driver=MAC,bridge=..."
-                # e.g. virtio=AA:BB.., or e1000=AA:BB..
-                # We iterate parts and look for a MAC-like string
-                if net0: 
-                    parts = net0.split(',')
-                    for p in parts:
-                        if '=' in p:
-                            val = p.split('=')[1]
-                            if len(val) == 17 and ':' in val and val.count(':') == 5:
-                                mac = val
-                                break
-                            
-                resources.append({
-                    "type": "qemu", 
-                    "name": vm.get('name'), 
-                    "id": vmid, 
-                    "status": vm.get('status'), 
-                    "parent": node_name,
-                    "mac": mac
-                })
-            
-            # LXCs
-            lxcs = self.get_lxcs(node_name)
-            for lxc in lxcs:
-                vmid = lxc.get('vmid')
-                config = self.get_lxc_config(node_name, vmid)
-                # LXC net0: name=eth0,bridge=vmbr0,hwaddr=AA:BB:CC...
-                mac = ""
-                net0 = config.get('net0', '')
-                if 'hwaddr=' in net0:
-                    try:
-                        mac = net0.split('hwaddr=')[1].split(',')[0]
-                    except:
-                        pass
-                
-                resources.append({
-                    "type": "lxc", 
-                    "name": lxc.get('name'), 
-                    "id": vmid, 
-                    "status": lxc.get('status'), 
-                    "parent": node_name,
-                    "mac": mac
-                })
-                
+        nodes = self._get_cluster_nodes()
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            for node in nodes:
+                self._collect_node_resources(ex, node['node'], resources)
         return resources
+
+    def _collect_node_resources(self, ex, node_name, resources):
+        # Add the node itself
+        resources.append({"type": "node", "name": node_name, "id": node_name, "status": "online"})
+        
+        # VMs and LXCs, with per-guest configs fetched concurrently
+        vms = self.get_vms(node_name)
+        lxcs = self.get_lxcs(node_name)
+        vm_cfgs = ex.map(lambda v: self.get_vm_config(node_name, v.get('vmid')), vms)
+        lxc_cfgs = ex.map(lambda c: self.get_lxc_config(node_name, c.get('vmid')), lxcs)
+
+        for vm, config in zip(vms, vm_cfgs):
+            vmid = vm.get('vmid')
+            mac = parse_mac(config.get('net0', ''))
+
+            resources.append({
+                "type": "qemu", 
+                "name": vm.get('name'), 
+                "id": vmid, 
+                "status": vm.get('status'), 
+                "parent": node_name,
+                "mac": mac
+            })
+        
+        # LXCs
+        for lxc, config in zip(lxcs, lxc_cfgs):
+            vmid = lxc.get('vmid')
+            mac = parse_mac(config.get('net0', ''))
+
+            resources.append({
+                "type": "lxc", 
+                "name": lxc.get('name'), 
+                "id": vmid, 
+                "status": lxc.get('status'), 
+                "parent": node_name,
+                "mac": mac
+            })
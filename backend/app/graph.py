@@ -1,25 +1,75 @@
 import networkx as nx
+import ipaddress
 import json
+import re
+
+# Hostname keywords per device type, in priority order (earlier types win)
+DEVICE_TYPE_KEYWORDS = (
+    ('Smart TV', ('tv', 'shield', 'firestick')),
+    ('Camera', ('camera', 'cam')),
+    ('Mobile', ('phone', 'pixel', 'iphone')),
+    ('Voice Assistant', ('alexa', 'echo', 'google')),
+    ('Printer', ('printer',)),
+    ('Computer', ('desktop', 'pc', 'laptop', 'macbook')),
+    ('Server', ('proxmox',)),
+    ('Router', ('opnsense',)),
+)
+TYPE_MAP = {kw: (rank, dtype) for rank, (dtype, kws) in enumerate(DEVICE_TYPE_KEYWORDS) for kw in kws}
+# Zero-width lookahead so overlapping keywords (e.g. "pc" in "pcamera") are all found in one pass
+CLASSIFIER = re.compile("(?=(%s))" % "|".join(sorted(TYPE_MAP, key=len, reverse=True)))
+
+def classify_hostname(h):
+    """Map a casefolded hostname to a device type using the highest-priority keyword it contains."""
+    ranked = [TYPE_MAP[kw] for kw in CLASSIFIER.findall(h)]
+    return min(ranked)[1] if ranked else 'Device'
+
+# --- Defined Hardware MACs ---
+MAIN_SWITCH_MAC = "d8:07:b6:75:2f:f4"
+MAIN_ROUTER_MAC = "60:a4:b7:5c:5a:00"
+IOT_ROUTER_MAC = "e4:f4:c6:0b:33:1d"
+STREAMING_SWITCH_MAC = "54:07:7d:27:69:71"
+
+# VLANs hanging off the IoT Router
+IOT_NETS = (ipaddress.IPv4Network("192.168.20.0/24"), ipaddress.IPv4Network("192.168.30.0/24"))
+
+def in_iot_net(ip):
+    try:
+        addr = ipaddress.IPv4Address(ip)
+    except ValueError:
+        return False
+    return any(addr in net for net in IOT_NETS)
+
+CRITICAL_NODES = frozenset({"Main Switch", "Main Router", "IoT Router", "OPNsense"})
+
+INFRA_BY_MAC = {
+    MAIN_SWITCH_MAC: "Main Switch",
+    MAIN_ROUTER_MAC: "Main Router",
+    IOT_ROUTER_MAC: "IoT Router",
+    STREAMING_SWITCH_MAC: "Streaming Switch",
+}
 
 class NetworkGraph:
     def __init__(self):
         self.graph = nx.Graph()
         self.last_update = None
+        # Scan bookkeeping so updates only touch what changed
+        self._scan_devices = {}    # node id -> scan fields from the last scan
+        self._device_attrs = {}    # node id -> (attrs, parent) as last placed by a scan
+        self._proxmox_ids = set()  # node ids last touched by add_proxmox_resources
+        # Bumped on every mutation; keys the memoized React Flow payload
+        self._revision = 0
+        self._rf_cache = (None, None)  # (revision, payload)
+        self._build_backbone()
+        self._infra_ids = set(self.graph.nodes)
 
-    def update_from_scan(self, devices):
+    @property
+    def revision(self):
+        return self._revision
+
+    def _build_backbone(self):
         """
-        Update the graph with devices found in the scan and specific user topology.
+        Add the fixed infrastructure of the user topology. Built once and kept across scans.
         """
-        import datetime
-        self.last_update = datetime.datetime.utcnow().isoformat()
-        self.graph.clear() # Rebuild graph to ensure clean state with new rules
-        
-        # --- Defined Hardware MACs ---
-        MAIN_SWITCH_MAC = "d8:07:b6:75:2f:f4"
-        MAIN_ROUTER_MAC = "60:a4:b7:5c:5a:00"
-        IOT_ROUTER_MAC = "e4:f4:c6:0b:33:1d"
-        STREAMING_SWITCH_MAC = "54:07:7d:27:69:71"
-        
         # --- Core Backbone Nodes ---
         # 1. Cable Modem (Public)
         self.graph.add_node("Cable Modem", label="Cable Modem", type='infrastructure', ip="Public IP")
@@ -46,117 +96,162 @@ class NetworkGraph:
         self.graph.add_node("Streaming Switch", label="Streaming Switch", type='infrastructure', mac=STREAMING_SWITCH_MAC, ip="192.168.1.4")
         self.graph.add_edge("Main Switch", "Streaming Switch")
 
+    def _set_parent(self, node_id, parent):
+        """Attach a leaf node to `parent`, dropping any previous uplink."""
+        for nbr in list(self.graph.neighbors(node_id)):
+            if nbr != parent:
+                self.graph.remove_edge(node_id, nbr)
+        self.graph.add_edge(parent, node_id)
+
+    def _update_infra(self, node_name, ip, mac):
+        """Store the scanned IP/MAC on an infrastructure node, keeping its fixed label."""
+        if self.graph.has_node(node_name):
+            self.graph.nodes[node_name]['ip'] = ip
+            self.graph.nodes[node_name]['mac'] = mac
+
+    def _place_device(self, ip, device):
+        """Work out the (attrs, parent) placement of an ordinary scanned device."""
+        mac = device['mac']
+        hostname = device.get('hostname') or 'Unknown'
+        h_lower = hostname.casefold()  # computed once; also folds non-ASCII names
+        description = device.get('description', '')
+
+        # Label logic: Description > Hostname > Unknown/Blank (but we need ID to select it)
+        display_name = description if description else hostname
+        if not display_name or display_name == 'Unknown':
+             # If truly unknown, maybe leave blank? User said "name will be left blank".
+             # But we need something to click on? Maybe just IP? 
+             # "if hostname is unavailable then the name will be left blank"
+             display_name = "" 
+
+        # Skip infrastructure nodes already added manually (to avoid duplicates, though ID matching handles it)
+        # We construct IDs based on IP or specific names for infra
 
-        # --- Device Placement Logic ---
+        # Label is strictly the display name for now? UI will "unroll" to show IP/MAC.
+        # But we need to pass IP/MAC in 'data', not burned into 'label' string for the UI to handle it cleanly.
+        # Backend currently burns it into 'label'. We should change this to pass structured data.
+        # However, for compat with existing 'default' nodes, we might keep label for now and add metadata.
+
+        label = display_name if display_name else "(Unnamed)" # Placeholder so it isn't invisible? Or truly blank?
+        if not display_name: label = " " # Space for blank?
+
+        # Old logic included IP/MAC in label text. New requirement says "unroll to show".
+        # So the visual label on the graph should JUST be the name.
+        # We will store extra info in 'data' attributes for the frontend to use.
+
+        # Identify Infrastructure IPs to update labels/IDs
+        # PROXMOX HOST, SWITCHES, ROUTERS
+
+        # Special Case: Proxmox Host ?
+        # If we see the Proxmox IP in the scan, update the Proxmox-Host node
+        # PROXMOX_HOST from env might be the way, but scan is better as it has MAC.
+        # We don't have Proxmox MAC in constants yet.
+        # But we created Proxmox-Host manually.
+        # If the IP matches env PROXMOX_HOST (ignoring port) -> update it.
+
+
+        # Add ordinary device node
+        # Determine type
+        dtype = classify_hostname(h_lower)
+
+        # Connect to appropriate parent
+        if in_iot_net(ip):
+            # Subnets .20 and .30 go to IoT Router
+            # Exception: PoE Cameras on .30 hooked to Main Switch
+            # We need a way to ID cameras. Keyword match via the classifier.
+            if dtype == 'Camera':
+                parent = "Main Switch"
+            else:
+                parent = "IoT Router"
+        elif dtype == 'Smart TV':
+            # Streaming devices
+            parent = "Streaming Switch"
+        else:
+            # Default .1.x devices go to Main Switch (or Main Router? User didn't specify distinct clients for Main Router)
+            # "Main Switch ... feeds the rest of the network"
+            parent = "Main Switch"
+
+        return {'label': label, 'mac': mac, 'type': dtype, 'ip': ip}, parent
+
+    def update_from_scan(self, devices):
+        """
+        Update the graph with devices found in the scan and specific user topology.
+        The scan is diffed against the previous one and only the delta is applied.
+        """
+        import datetime
+        self.last_update = datetime.datetime.utcnow().isoformat()
+        # last_update is part of the React Flow payload, so every scan is a new revision
+        self._revision += 1
+
+        current = {}  # node id -> scan fields that drive placement
         for device in devices:
             ip = device.get('ip', '')
+            if not ip: continue
             mac = device.get('mac', '').lower()
-            hostname = device.get('hostname', 'Unknown')
-            description = device.get('description', '')
-            
-            # Label logic: Description > Hostname > Unknown/Blank (but we need ID to select it)
-            display_name = description if description else hostname
-            if not display_name or display_name == 'Unknown':
-                 # If truly unknown, maybe leave blank? User said "name will be left blank".
-                 # But we need something to click on? Maybe just IP? 
-                 # "if hostname is unavailable then the name will be left blank"
-                 display_name = "" 
-            
-            # Skip infrastructure nodes already added manually (to avoid duplicates, though ID matching handles it)
-            # We construct IDs based on IP or specific names for infra
-            
-            node_id = ip
-            # Label is strictly the display name for now? UI will "unroll" to show IP/MAC.
-            # But we need to pass IP/MAC in 'data', not burned into 'label' string for the UI to handle it cleanly.
-            # Backend currently burns it into 'label'. We should change this to pass structured data.
-            # However, for compat with existing 'default' nodes, we might keep label for now and add metadata.
-            
-            label = display_name if display_name else "(Unnamed)" # Placeholder so it isn't invisible? Or truly blank?
-            if not display_name: label = " " # Space for blank?
-            
-            # Old logic included IP/MAC in label text. New requirement says "unroll to show".
-            # So the visual label on the graph should JUST be the name.
-            # We will store extra info in 'data' attributes for the frontend to use.
-            
-            # Identify Infrastructure IPs to update labels/IDs
-            # PROXMOX HOST, SWITCHES, ROUTERS
-            
-            # Helper to update infra info if matched
-            def update_infra(node_name, ip, mac):
-                 if self.graph.has_node(node_name):
-                     self.graph.nodes[node_name]['ip'] = ip
-                     self.graph.nodes[node_name]['mac'] = mac
-                     # Ensure label doesn't get messed up if it was manually set
-                     # Actually, infra labels are set above (lines 25-47)
-                     # We just want to ensure the data is there
-                     pass
-
-            if mac == MAIN_SWITCH_MAC:
-                update_infra("Main Switch", ip, mac)
-                continue 
-            if mac == MAIN_ROUTER_MAC:
-                update_infra("Main Router", ip, mac)
-                continue
-            if mac == IOT_ROUTER_MAC:
-                update_infra("IoT Router", ip, mac)
+
+            # Known infrastructure hardware: refresh its node instead of adding a device
+            infra = INFRA_BY_MAC.get(mac)
+            if infra:
+                self._update_infra(infra, ip, mac)
                 continue
-            if mac == STREAMING_SWITCH_MAC:
-                update_infra("Streaming Switch", ip, mac)
+
+            current[ip] = {
+                'mac': mac,
+                'hostname': device.get('hostname') or 'Unknown',
+                'description': device.get('description', ''),
+            }
+
+        previous = self._scan_devices
+        added = current.keys() - previous.keys()
+        removed = previous.keys() - current.keys()
+        changed = {n for n in current.keys() & previous.keys() if current[n] != previous[n]}
+        self._scan_devices = current
+
+        self.apply_delta(added, removed, changed, current)
+
+    def apply_delta(self, added, removed, changed, devices_by_id):
+        """
+        Apply a scan delta: drop `removed` node ids and (re)place `added` and `changed` ones
+        from `devices_by_id`. Unchanged devices are not touched, keeping any Proxmox enrichment.
+        """
+        if not (added or removed or changed):
+            return
+
+        for node_id in removed:
+            if self.graph.has_node(node_id):
+                self.graph.remove_node(node_id)
+            self._device_attrs.pop(node_id, None)
+
+        for node_id in added | changed:
+            placement = self._place_device(node_id, devices_by_id[node_id])
+            if self._device_attrs.get(node_id) == placement:
                 continue
-            
-            # Special Case: Proxmox Host ?
-            # If we see the Proxmox IP in the scan, update the Proxmox-Host node
-            # PROXMOX_HOST from env might be the way, but scan is better as it has MAC.
-            # We don't have Proxmox MAC in constants yet.
-            # But we created Proxmox-Host manually.
-            # If the IP matches env PROXMOX_HOST (ignoring port) -> update it.
+            attrs, parent = placement
+            self.add_node_safe(node_id, **attrs)
+            self._set_parent(node_id, parent)
+            self._device_attrs[node_id] = placement
 
-            
-            # Add ordinary device node
-            # Determine type
-            dtype = 'Device'
-            h = hostname.lower()
-            if "tv" in h or "shield" in h or "firestick" in h: dtype = 'Smart TV'
-            elif "camera" in h or "cam" in h: dtype = 'Camera'
-            elif "phone" in h or "pixel" in h or "iphone" in h: dtype = 'Mobile'
-            elif "alexa" in h or "echo" in h or "google" in h: dtype = 'Voice Assistant'
-            elif "printer" in h: dtype = 'Printer'
-            elif "desktop" in h or "pc" in h or "laptop" in h or "macbook" in h: dtype = 'Computer'
-            elif "proxmox" in h: dtype = 'Server'
-            elif "opnsense" in h: dtype = 'Router'
-            
-            self.graph.add_node(node_id, label=label, mac=mac, type=dtype, ip=ip)
-            
-            # Connect to appropriate parent
-            if ip.startswith("192.168.20.") or ip.startswith("192.168.30."):
-                # Subnets .20 and .30 go to IoT Router
-                # Exception: PoE Cameras on .30 hooked to Main Switch
-                # We need a way to ID cameras. Keyword match?
-                if "camera" in hostname.lower() or "cam" in hostname.lower():
-                    self.graph.add_edge("Main Switch", node_id)
-                else:
-                    self.graph.add_edge("IoT Router", node_id)
-            elif "tv" in hostname.lower() or "firestick" in hostname.lower() or "shield" in hostname.lower():
-                # Streaming devices
-                self.graph.add_edge("Streaming Switch", node_id)
-            else:
-                # Default .1.x devices go to Main Switch (or Main Router? User didn't specify distinct clients for Main Router)
-                # "Main Switch ... feeds the rest of the network"
-                self.graph.add_edge("Main Switch", node_id)
+        self._revision += 1
 
     def add_node_safe(self, node_id, **kwargs):
         """Helper to add/update node without losing existing data"""
         if self.graph.has_node(node_id):
-            self.graph.nodes[node_id].update(kwargs)
+            data = self.graph.nodes[node_id]
+            if all(k in data and data[k] == v for k, v in kwargs.items()):
+                return  # nothing new; keep the memoized payload valid
+            data.update(kwargs)
         else:
             self.graph.add_node(node_id, **kwargs)
+        self._revision += 1
 
     def add_proxmox_resources(self, resources, arp_map=None):
         """
         Add Proxmox nodes, VMs, and LXCs to the graph to specific location.
         arp_map: dict of mac -> {ip, hostname} from scanner
         """
-        arp_map = arp_map or {}
+        # Lookups below are by lowercased MAC; normalize once so they stay O(1) dict hits
+        arp_map = {k.lower(): v for k, v in (arp_map or {}).items()}
+        touched = set()
         
         for res in resources:
             name = res.get('name')
@@ -202,18 +297,34 @@ class NetworkGraph:
                     self.graph.nodes[node_id].update(node_data_attribs)
                     
                     # Ensure correct parentage (OPNsense)
-                    for u, v in list(self.graph.edges(node_id)):
-                        self.graph.remove_edge(u, v)
-                    self.graph.add_edge("OPNsense", node_id)
+                    self._set_parent(node_id, "OPNsense")
                 else:
-                    # New node
-                    self.graph.add_node(target_id, **node_data_attribs)
-                    self.graph.add_edge("OPNsense", target_id)
+                    # New node (or one we added on a previous run)
+                    self.add_node_safe(target_id, **node_data_attribs)
+                    self._set_parent(target_id, "OPNsense")
+                touched.add(target_id)
+
+        # Guests no longer reported: restore scanned devices to their scan state, drop the rest
+        for node_id in self._proxmox_ids - touched:
+            if node_id in self._device_attrs:
+                attrs, parent = self._device_attrs[node_id]
+                data = self.graph.nodes[node_id]
+                data.clear()
+                data.update(attrs)
+                self._set_parent(node_id, parent)
+            elif self.graph.has_node(node_id):
+                self.graph.remove_node(node_id)
+        self._proxmox_ids = touched
+        self._revision += 1
 
     def get_react_flow_data(self):
         """
         Convert NetworkX graph to React Flow nodes and edges.
+        The payload is memoized until the graph changes; callers must not mutate it.
         """
+        if self._rf_cache[0] == self._revision:
+            return self._rf_cache[1]
+
         nodes = []
         edges = []
         
@@ -263,7 +374,9 @@ class NetworkGraph:
                 "target": v
             })
             
-        return {"nodes": nodes, "edges": edges, "last_update": self.last_update}
+        payload = {"nodes": nodes, "edges": edges, "last_update": self.last_update}
+        self._rf_cache = (self._revision, payload)
+        return payload
 
     def export_drawio_xml(self):
         # Todo: Implement MXGraph XML generation
@@ -274,35 +387,30 @@ class NetworkGraph:
         Generate alerts based on graph state (missing infrastructure, etc)
         """
         alerts = []
+        timestamp = self.last_update or "Now"
+
         # Check integrity of core backbone
-        critical_nodes = ["Main Switch", "Main Router", "IoT Router", "OPNsense"]
-        
-        for node in critical_nodes:
-            if not self.graph.has_node(node):
-                alerts.append({
-                    "severity": "error",
-                    "message": f"Critical Infrastructure Missing: {node}",
-                    "timestamp": self.last_update or "Now"
-                })
-            else:
-                 pass
+        for node in sorted(CRITICAL_NODES - self.graph.nodes):
+            alerts.append({
+                "severity": "error",
+                "message": f"Critical Infrastructure Missing: {node}",
+                "timestamp": timestamp
+            })
                  
         # Check for Unknown/New Devices (Intrusion Detection Lite)
         for node_id, data in self.graph.nodes(data=True):
-            if data.get('type') == 'infrastructure': continue
+            if node_id in self._infra_ids: continue
             
-            # Criteria for suspicious: Unknown hostname AND no Description
-            label = data.get('label', '')
-            hostname = data.get('hostname', '') # We might not have stored hostname on node directly, just label.
-            # We better check how we store data.
-            # In update_from_scan, we set 'label' to display_name.
+            # Criteria for suspicious: Unknown hostname AND no Description.
+            # In update_from_scan, 'label' is set to the display name (description > hostname).
+            label = data.get('label') or ''
             
             # If label is empty or "Unknown", flag it.
-            if not label or "Unknown" in label or label.strip() == "":
+            if not label.strip() or "Unknown" in label:
                 alerts.append({
                     "severity": "warning",
                     "message": f"Unknown Device Detected: {data.get('ip', 'No IP')}",
-                    "timestamp": self.last_update or "Now"
+                    "timestamp": timestamp
                 })
                  
         return alerts
@@ -1,13 +1,23 @@
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-import requests
+from fastapi.responses import StreamingResponse
+import asyncio
+import hashlib
+import ipaddress
+import orjson
+from app.cache import TTLCache
+from app.clients.session import create_session
 from app.clients.proxmox import ProxmoxClient
 from app.clients.opnsense import OpnSenseClient
 from app.scanner import NetworkScanner
 from app.graph import NetworkGraph
 from app.graph import NetworkGraph
 from app.ai.local import LocalAI
+from app.responses import ORJSONResponse
 import logging
+import os
+import uuid
+from contextlib import asynccontextmanager, suppress
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -17,7 +27,19 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Network Monitor API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.scan_task = asyncio.create_task(scan_loop())
+    yield
+    app.state.scan_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await app.state.scan_task
+    # Release pooled HTTP connections on shutdown
+    opnsense_client.close()
+    local_ai.close()
+    http_session.close()
+
+app = FastAPI(title="Network Monitor API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Allow requests from the frontend
 app.add_middleware(
@@ -34,7 +56,23 @@ proxmox_client = ProxmoxClient()
 opnsense_client = OpnSenseClient()
 net_graph = NetworkGraph()
 local_ai = LocalAI()
-last_notification_time = 0.0
+# Keep-alive session for outbound calls (ipify, ntfy.sh)
+http_session = create_session()
+NOTIFY_DEDUPE_TTL = 3600
+notified = TTLCache(ttl=NOTIFY_DEDUPE_TTL, maxsize=1024)  # blake2b(message) of errors already sent to ntfy
+NTFY_TOPIC = os.getenv("NTFY_TOPIC")
+PUBLIC_IP_TTL = 3600
+public_ip_cache = TTLCache(ttl=PUBLIC_IP_TTL, maxsize=1)
+
+# Scans run in a single long-lived task: periodically, or early when /api/scan sets the event.
+# SCAN_INTERVAL=0 disables periodic scans (on demand only).
+SCAN_INTERVAL = float(os.getenv("SCAN_INTERVAL", "300"))
+scan_event = asyncio.Event()
+scan_lock = asyncio.Lock()
+graph_body = (None, b"")  # (graph revision, serialized /api/graph payload)
+# Revisions restart at 0 with the process; the seed keeps ETags from matching across restarts
+GRAPH_ETAG_SEED = uuid.uuid4().hex
+ai_alerts_cache = (None, [])  # (hash of analyzed state, AI alerts)
 
 @app.get("/")
 def read_root():
@@ -45,22 +83,74 @@ def health_check():
     return {"status": "ok"}
 
 @app.post("/api/scan")
-def trigger_scan(background_tasks: BackgroundTasks):
-    background_tasks.add_task(run_scan)
+async def trigger_scan():
+    # Wake the scan loop; repeated clicks while a scan is pending coalesce into one
+    scan_event.set()
     return {"status": "Scan started in background"}
 
-def run_scan():
+async def scan_loop():
+    while True:
+        try:
+            await asyncio.wait_for(scan_event.wait(), timeout=SCAN_INTERVAL or None)
+        except asyncio.TimeoutError:
+            pass
+        scan_event.clear()
+        async with scan_lock:
+            scan = asyncio.create_task(run_scan())
+            try:
+                await asyncio.shield(scan)
+            except asyncio.CancelledError:
+                # Shutting down: let the in-flight scan's worker threads finish with the clients first
+                await asyncio.wait([scan])
+                raise
+            except Exception as e:
+                logger.error(f"Scan cycle failed: {e}")
+
+def fetch_public_ip():
+    # The WAN address rarely changes, so only ask ipify once per PUBLIC_IP_TTL
+    ip = public_ip_cache.get("ip")
+    if ip is None:
+        res = http_session.get('https://api.ipify.org', timeout=3)
+        res.raise_for_status()
+        # Raises ValueError on anything but an address, so error pages never get cached
+        ip = str(ipaddress.ip_address(res.text.strip()))
+        public_ip_cache.set("ip", ip)
+    return ip
+
+async def run_scan():
     logger.info("Starting background network scan...")
-    
+
+    # The network scan, OPNsense, Proxmox and public IP lookups are independent
+    # I/O, so run them concurrently; total time is the slowest one, not the sum.
+    # The clients are synchronous (pooled requests sessions), hence to_thread.
+    devices, opn_data, pmx_resources, public_ip = await asyncio.gather(
+        scanner.scan_async(),
+        asyncio.to_thread(opnsense_client.snapshot, "arp", "dhcp"),
+        asyncio.to_thread(proxmox_client.get_all_resources),
+        asyncio.to_thread(fetch_public_ip),
+        return_exceptions=True
+    )
+
     # 1. Network Scan
-    devices = scanner.scan()
+    if isinstance(devices, Exception):
+        logger.error(f"Network scan failed: {devices}")
+        devices = []
     
+    # O(1) lookup for merging ARP entries into scanned devices
+    devices_by_ip = {d['ip']: d for d in devices}
+
     # 2. OPNsense Data Enrichment
+    opn_leases = []
+    # MAC -> {ip, hostname} for Proxmox correlation; DHCP entries are filled in below
+    combined_lookup = {}
     try:
+        if isinstance(opn_data, Exception):
+            raise opn_data
+
         # Fetch ARP Table - PRIMARY SOURCE for remote subnets
-        arp_table = opnsense_client.get_arp_table() or []
+        arp_table = opn_data["arp"] or []
         
-        # Merge ARP data into devices
+        # Merge ARP data into devices (MACs arrive lowercased from the client and scanner)
         # ARP table likely has: {"ip": "...", "mac": "...", "hostname": "...", "interface": "..."} or similar
         # We need to adapt it.
         for entry in arp_table:
@@ -71,7 +161,7 @@ def run_scan():
             if not ip or not mac: continue
             
             # Check if device already exists
-            existing = next((d for d in devices if d['ip'] == ip), None)
+            existing = devices_by_ip.get(ip)
             if existing:
                 # Update MAC if missing (Scanner might miss MACs for remote subnets)
                 if not existing.get('mac') and mac:
@@ -80,18 +170,29 @@ def run_scan():
                     existing['hostname'] = hostname
             else:
                 # Add new device from ARP
-                devices.append({
+                device = {
                     "ip": ip,
                     "mac": mac,
                     "hostname": hostname or "Unknown"
-                })
+                }
+                devices.append(device)
+                devices_by_ip[ip] = device
 
-        opn_leases = opnsense_client.get_dhcp_leases() or []
+        opn_leases = opn_data["dhcp"] or []
         
         # Enrich devices with DHCP data (Hostname, Description)
         # Create lookups
-        lease_by_ip = {l['address']: l for l in opn_leases if 'address' in l}
-        lease_by_mac = {l['mac'].lower(): l for l in opn_leases if 'mac' in l}
+        # One pass over the leases builds both lookups plus the DHCP part of combined_lookup
+        lease_by_ip, lease_by_mac = {}, {}
+        for l in opn_leases:
+            ip = l.get('address')
+            mac = l.get('mac')
+            if ip:
+                lease_by_ip[ip] = l
+            if mac:
+                lease_by_mac[mac] = l
+                if ip:
+                    combined_lookup[mac] = {'ip': ip, 'hostname': l.get('hostname', '')}
         
         for d in devices:
             # 1. Enrich existing devices
@@ -114,48 +215,58 @@ def run_scan():
     net_graph.update_from_scan(devices)
     
     # Resolve Public IP (if possible)
-    try:
-        public_ip = requests.get('https://api.ipify.org', timeout=3).text
-        if net_graph.graph.has_node("Cable Modem"):
-             net_graph.graph.nodes["Cable Modem"]['ip'] = public_ip
-    except Exception as e:
-        logger.warning(f"Could not resolve public IP: {e}")
+    if isinstance(public_ip, Exception):
+        logger.warning(f"Could not resolve public IP: {public_ip}")
+    elif net_graph.graph.has_node("Cable Modem"):
+        net_graph.add_node_safe("Cable Modem", ip=public_ip)
     
     # Create ARP/Lease Map for Proxmox Correlation
     # We want to find IP for a given MAC.
     # Priority: Scanned/ARP (Active) > DHCP Lease (Reserved/Recent)
     
-    combined_lookup = {}
-    
-    # 1. Fill with DHCP first (lower priority, overwritten by active ARP)
-    for l in opn_leases:
-        if 'mac' in l and 'address' in l:
-            combined_lookup[l['mac'].lower()] = {'ip': l['address'], 'hostname': l.get('hostname', '')}
-            
+    # 1. DHCP leases first (lower priority), already filled in while indexing the leases
     # 2. Overwrite with active devices from scan/ARP
-    for d in devices:
-        if 'mac' in d and 'ip' in d:
-            combined_lookup[d['mac'].lower()] = d
+    devices_by_mac = {d['mac']: d for d in devices if d.get('mac') and d.get('ip')}
+    combined_lookup.update(devices_by_mac)
 
     # 3. Proxmox Scan
-    logger.info("Fetching Proxmox resources...")
     try:
-        pmx_resources = proxmox_client.get_all_resources() or []
-        net_graph.add_proxmox_resources(pmx_resources, arp_map=combined_lookup)
+        if isinstance(pmx_resources, Exception):
+            raise pmx_resources
+        net_graph.add_proxmox_resources(pmx_resources or [], arp_map=combined_lookup)
     except Exception as e:
         logger.error(f"Error fetching Proxmox data: {e}")
         
     logger.info(f"Scan cycle complete.")
 
 @app.get("/api/graph")
-def get_graph():
-    return net_graph.get_react_flow_data()
+async def get_graph(request: Request):
+    global graph_body
+    revision = net_graph.revision
+    # Weak ETag per process and graph revision; no-cache makes browsers revalidate and reuse on 304
+    etag = f'W/"{GRAPH_ETAG_SEED}-{revision}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    # The graph only changes between scans; serialize once per revision
+    if graph_body[0] != revision:
+        graph_body = (revision, orjson.dumps(net_graph.get_react_flow_data(), option=orjson.OPT_NON_STR_KEYS))
+    return Response(content=graph_body[1], media_type="application/json", headers=headers)
 
 @app.get("/api/alerts")
-def get_alerts():
+async def get_alerts():
     alerts = []
+    # OPNsense status and the Proxmox reachability check are independent upstream calls
+    opn_alerts, nodes = await asyncio.gather(
+        asyncio.to_thread(opnsense_client.get_alerts),
+        asyncio.to_thread(proxmox_client.get_nodes),
+        return_exceptions=True
+    )
+
     # 1. OPNsense System Alerts
-    opn_alerts = opnsense_client.get_alerts()
+    if isinstance(opn_alerts, Exception):
+        logger.error(f"Error fetching OPNsense alerts: {opn_alerts}")
+        opn_alerts = []
     if opn_alerts:
         alerts.extend(opn_alerts)
         
@@ -168,15 +279,25 @@ def get_alerts():
     # We need to get the current devices list. 
     # Assuming net_graph has a way to provide the list of devices or we can get it from the graph.
     # For now, let's try to get it from net_graph if possible.
+    global ai_alerts_cache
     try:
-        # Extract devices from the graph nodes for analysis
-        devices = []
-        if hasattr(net_graph, 'graph'):
-            for node_id, data in net_graph.graph.nodes(data=True):
-               # convert node data back to device dict format if possible or just pass data
-               devices.append(data)
-        
-        ai_alerts = local_ai.analyze(devices, opn_alerts)
+        # Polls between state changes reuse the last analysis instead of re-running the model
+        nodes_data = list(net_graph.graph.nodes(data=True))
+        state_key = hash((
+            local_ai.enabled,
+            tuple((d.get('ip'), d.get('mac'), d.get('label'), d.get('type'), d.get('status')) for _, d in nodes_data),
+            tuple((a.get('severity'), a.get('message')) for a in opn_alerts or []),
+        ))
+        if ai_alerts_cache[0] == state_key:
+            ai_alerts = ai_alerts_cache[1]
+        else:
+            # Extract devices from the graph nodes for analysis
+            # (copied, since analysis runs on a worker thread while scans mutate the graph)
+            devices = [dict(data) for _, data in nodes_data]
+            ai_alerts, from_model = await asyncio.to_thread(local_ai.analyze_with_source, devices, opn_alerts)
+            # Heuristic fallbacks (transient Ollama errors, bad output) are retried on the next poll
+            if from_model:
+                ai_alerts_cache = (state_key, ai_alerts)
         if ai_alerts:
             alerts.extend(ai_alerts)
     except Exception as e:
@@ -184,12 +305,10 @@ def get_alerts():
         
     # 3. Proxmox Connection Check
     # Quick check if we can reach nodes
-    try:
-        nodes = proxmox_client.get_nodes()
-        if not nodes:
-             alerts.append({"severity": "warning", "message": "Proxmox API unreachable or no nodes found", "timestamp": "Now"})
-    except Exception as e:
-         alerts.append({"severity": "error", "message": f"Proxmox Connection Error: {str(e)}", "timestamp": "Now"})
+    if isinstance(nodes, Exception):
+         alerts.append({"severity": "error", "message": f"Proxmox Connection Error: {str(nodes)}", "timestamp": "Now"})
+    elif not nodes:
+         alerts.append({"severity": "warning", "message": "Proxmox API unreachable or no nodes found", "timestamp": "Now"})
 
     # 4. Internet Connectivity (Check Public IP existence on Cable Modem node)
     if net_graph.graph.has_node("Cable Modem"):
@@ -198,55 +317,68 @@ def get_alerts():
              pass
 
     # Simple Notification dispatch (ntfy.sh)
-    # To avoid spam, we check a global timestamp.
+    # Each distinct error is sent once per NOTIFY_DEDUPE_TTL, however often it is polled.
     # Note: Global state in a module works for single worker Uvicorn.
-    global last_notification_time
-    import time
-    import os
-    
-    cutoff = time.time() - 600 # 10 minutes ago
-    
-    topic = os.getenv("NTFY_TOPIC")
-    error_alerts = [a for a in alerts if a['severity'] == 'error']
-    
-    if topic and error_alerts:
-        if last_notification_time < cutoff:
+    if NTFY_TOPIC:
+        fresh = {}
+        for a in alerts:
+            message = a.get('message')
+            if a.get('severity') != 'error' or not isinstance(message, str):
+                continue
+            key = hashlib.blake2b(message.encode(), digest_size=8).digest()
+            if key not in notified and key not in fresh:
+                fresh[key] = message
+
+        if fresh:
+            # Reserve before the await so an overlapping poll doesn't send the same errors
+            for key in fresh:
+                notified.set(key, True)
             try:
                 # Summarize errors
-                msg_body = "Errors detected:\n" + "\n".join([f"- {a['message']}" for a in error_alerts])
+                msg_body = "Errors detected:\n" + "\n".join([f"- {message}" for message in fresh.values()])
                 
-                requests.post(f"https://ntfy.sh/{topic}", 
+                res = await asyncio.to_thread(http_session.post, f"https://ntfy.sh/{NTFY_TOPIC}", 
                     data=msg_body,
-                    headers={"Title": "NetMonitor Critical Alert", "Priority": "high", "Tags": "rotating_light"})
-                last_notification_time = time.time()
+                    headers={"Title": "NetMonitor Critical Alert", "Priority": "high", "Tags": "rotating_light"},
+                    timeout=5)
+                res.raise_for_status()
                 logger.info("Sent notification to ntfy.sh")
             except Exception as e:
+                # Release the reservation so these errors are retried on the next poll
+                for key in fresh:
+                    notified.discard(key)
                 logger.error(f"Failed to send notification: {e}")
 
     return alerts
 
 @app.post("/api/alerts/test-notify")
 def test_notification():
-    import os
-    topic = os.getenv("NTFY_TOPIC")
-    if not topic:
+    if not NTFY_TOPIC:
         return {"status": "error", "message": "NTFY_TOPIC not set in .env"}
     
     try:
-        requests.post(f"https://ntfy.sh/{topic}", 
+        http_session.post(f"https://ntfy.sh/{NTFY_TOPIC}", 
             data="This is a test notification from your Network Monitor.",
-            headers={"Title": "NetMonitor Test", "Tags": "tada"})
+            headers={"Title": "NetMonitor Test", "Tags": "tada"},
+            timeout=5)
         return {"status": "sent"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
 # --- Settings / Env Config ---
+def read_text(path):
+    with open(path, "r") as f:
+        return f.read()
+
+def write_text(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
 @app.get("/api/settings/env")
-def get_env_config():
-    # Read backend/.env file
+async def get_env_config():
+    # Read backend/.env file; disk I/O runs in a worker thread, off the event loop
     try:
-        with open(".env", "r") as f:
-            return {"content": f.read()}
+        return {"content": await asyncio.to_thread(read_text, ".env")}
     except FileNotFoundError:
          return {"content": ""}
 
@@ -255,10 +387,13 @@ class EnvConfig(BaseModel):
     content: str
 
 @app.post("/api/settings/env")
-def save_env_config(config: EnvConfig):
+async def save_env_config(config: EnvConfig):
+    global NTFY_TOPIC
     try:
-        with open(".env", "w") as f:
-            f.write(config.content)
+        await asyncio.to_thread(write_text, ".env", config.content)
+        # Pick up settings that are read once at import time
+        load_dotenv(".env", override=True)
+        NTFY_TOPIC = os.getenv("NTFY_TOPIC")
         return {"status": "saved"}
     except Exception as e:
          raise HTTPException(status_code=500, detail=str(e))
@@ -268,13 +403,12 @@ class GraphLayout(BaseModel):
     edges: list
 
 @app.post("/api/graph/save")
-def save_graph_layout(layout: GraphLayout):
+async def save_graph_layout(layout: GraphLayout):
     # For now, we can save this to a json file 'layout.json'
     # And logic in graph.py could prioritize this layout if it exists?
     # Or we just save it for future features.
     try:
-        with open("layout.json", "w") as f:
-            f.write(layout.json())
+        await asyncio.to_thread(write_text, "layout.json", layout.model_dump_json())
         return {"status": "saved"}
     except Exception as e:
         logger.error(f"Error saving layout: {e}")
@@ -283,29 +417,37 @@ def save_graph_layout(layout: GraphLayout):
 class ChatRequest(BaseModel):
     message: str
 
-@app.post("/api/ai/chat")
-def chat_with_ai(req: ChatRequest):
+def build_chat_context():
     # Gather context
     context = {}
     try:
-        # Get graph data
-        graph_data = net_graph.get_react_flow_data()
-        
-        # Simplify nodes for context to save tokens
-        simple_nodes = []
-        for node in graph_data.get('nodes', []):
-            simple_nodes.append({
-                "label": node.get('data', {}).get('label'),
-                "ip": node.get('data', {}).get('ip'),
-                "type": node.get('type')
-            })
-            
+        # Summarize straight from the graph to save tokens; the React Flow payload
+        # carries positions and styling the model never sees
+        simple_nodes = [
+            {"label": data.get('label', node_id), "ip": data.get('ip'), "type": data.get('type')}
+            for node_id, data in net_graph.graph.nodes(data=True)
+        ]
+
         context['nodes'] = simple_nodes
         context['node_count'] = len(simple_nodes)
         
     except Exception as e:
          logger.warning(f"Failed to gather context for AI: {e}")
-         
-    response = local_ai.chat(req.message, context)
+    return context
+
+@app.post("/api/ai/chat")
+async def chat_with_ai(req: ChatRequest):
+    response = await asyncio.to_thread(local_ai.chat, req.message, build_chat_context())
     return {"response": response}
 
+@app.post("/api/ai/chat/stream")
+async def chat_with_ai_stream(req: ChatRequest):
+    context = build_chat_context()
+
+    # Sync generator: Starlette iterates it in a worker thread, off the event loop
+    def events():
+        # One SSE event per generated chunk, JSON-encoded so newlines survive framing
+        for piece in local_ai.chat_stream(req.message, context):
+            yield f"data: {orjson.dumps(piece).decode()}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
@@ -1,4 +1,7 @@
 from scapy.all import ARP, Ether, srp
+from concurrent.futures import ThreadPoolExecutor
+from app.cache import TTLCache
+import asyncio
 import socket
 import logging
 
@@ -6,60 +9,80 @@ logger = logging.getLogger(__name__)
 
 import os
 
-# ...
+# Reverse DNS results are reused across scans for this long (seconds)
+DNS_CACHE_TTL = 600
+DNS_WORKERS = 16
 
 class NetworkScanner:
     def __init__(self, ip_range=None):
         self.ip_ranges = (ip_range or os.getenv("SCAN_RANGE", "192.168.1.0/24")).split(',')
+        self._dns_cache = TTLCache(ttl=DNS_CACHE_TTL, maxsize=4096)
 
     def scan(self):
         """
         Perform an ARP scan to discover devices on the local network.
         Returns a list of dictionaries containing IP and MAC addresses.
+        Synchronous wrapper around scan_async() for callers without an event loop.
         """
-        all_results = []
-        
-        for net_range in self.ip_ranges:
-            net_range = net_range.strip()
-            if not net_range: continue
-            
-            logger.info(f"Scanning {net_range}...")
-            try:
-                arp = ARP(pdst=net_range)
-                ether = Ether(dst="ff:ff:ff:ff:ff:ff")
-                packet = ether/arp
+        return asyncio.run(self.scan_async())
+
+    async def scan_async(self):
+        """
+        ARP-scan all configured ranges concurrently, one worker thread per range,
+        so N ranges cost about one timeout instead of N.
+        """
+        ranges = [r.strip() for r in self.ip_ranges if r.strip()]
+        results = await asyncio.gather(*[asyncio.to_thread(self._scan_one, r) for r in ranges],
+                                       return_exceptions=True)
+
+        # Merge, de-duplicating by IP in case ranges overlap
+        by_ip = {}
+        permission_denied = False
+        for net_range, result in zip(ranges, results):
+            if isinstance(result, PermissionError):
+                permission_denied = True
+            elif isinstance(result, Exception):
+                logger.error(f"Scan error on {net_range}: {result}")
+            else:
+                for device in result:
+                    by_ip.setdefault(device['ip'], device)
 
-                # timeout=2, verbose=0
-                timeout_val = int(os.getenv("SCAN_TIMEOUT", "2"))
-                ans, _ = srp(packet, timeout=timeout_val, verbose=0, iface=None)
-                
-                for sent, received in ans:
-                    device = {
-                        "ip": received.psrc,
-                        "mac": received.hwsrc,
-                        "hostname": self._get_hostname(received.psrc)
-                    }
-                    # Avoid duplicates if ranges overlap
-                    if not any(d['ip'] == device['ip'] for d in all_results):
-                        all_results.append(device)
-                        
-            except PermissionError:
-                logger.error("Permission denied: scapy requires root privileges. Returning MOCK data.")
-                # Only return mock once
-                if not all_results:
-                     return [
-                        {"ip": "192.168.1.1", "mac": "AA:BB:CC:DD:EE:01", "hostname": "Gateway"},
-                        {"ip": "192.168.1.100", "mac": "AA:BB:CC:DD:EE:02", "hostname": "Proxmox-Server"},
-                        {"ip": "192.168.1.105", "mac": "AA:BB:CC:DD:EE:03", "hostname": "Desktop-PC"},
-                        {"ip": "192.168.1.200", "mac": "AA:BB:CC:DD:EE:04", "hostname": "Smart-TV"},
-                    ]
-            except Exception as e:
-                logger.error(f"Scan error on {net_range}: {e}")
-                
-        return all_results
+        if permission_denied and not by_ip:
+            logger.error("Permission denied: scapy requires root privileges. Returning MOCK data.")
+            return [
+                {"ip": "192.168.1.1", "mac": "aa:bb:cc:dd:ee:01", "hostname": "Gateway"},
+                {"ip": "192.168.1.100", "mac": "aa:bb:cc:dd:ee:02", "hostname": "Proxmox-Server"},
+                {"ip": "192.168.1.105", "mac": "aa:bb:cc:dd:ee:03", "hostname": "Desktop-PC"},
+                {"ip": "192.168.1.200", "mac": "aa:bb:cc:dd:ee:04", "hostname": "Smart-TV"},
+            ]
+        return list(by_ip.values())
+
+    def _scan_one(self, net_range):
+        """Blocking ARP scan of a single range (runs in a worker thread)."""
+        logger.info(f"Scanning {net_range}...")
+        arp = ARP(pdst=net_range)
+        ether = Ether(dst="ff:ff:ff:ff:ff:ff")
+        packet = ether/arp
+
+        # timeout=2, verbose=0
+        timeout_val = int(os.getenv("SCAN_TIMEOUT", "2"))
+        ans, _ = srp(packet, timeout=timeout_val, verbose=0, iface=None)
+
+        replies = [(received.psrc, received.hwsrc.lower()) for sent, received in ans]
+        # Each reverse lookup is an independent resolver round-trip; run them in parallel
+        with ThreadPoolExecutor(max_workers=DNS_WORKERS) as ex:
+            hostnames = list(ex.map(self._get_hostname, [ip for ip, _ in replies]))
+
+        return [{"ip": ip, "mac": mac, "hostname": hostname}
+                for (ip, mac), hostname in zip(replies, hostnames)]
 
     def _get_hostname(self, ip):
-        try:
-            return socket.gethostbyaddr(ip)[0]
-        except socket.herror:
-            return "Unknown"
+        hostname = self._dns_cache.get(ip)
+        if hostname is None:
+            try:
+                hostname = socket.gethostbyaddr(ip)[0]
+            except OSError:
+                # herror (no PTR record) as well as resolver timeouts
+                hostname = "Unknown"
+            self._dns_cache.set(ip, hostname)
+        return hostname